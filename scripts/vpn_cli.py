@@ -24,19 +24,11 @@ from __future__ import annotations
 
 import argparse
 import json
-import mimetypes
 import os
 import subprocess
 import sys
-import tempfile
-import zipfile
 from pathlib import Path
-from typing import NoReturn, Optional
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
-
-import xray_reality_qr
+from typing import Any, Callable, Iterator, NoReturn, Optional, Union
 
 
 class UserError(RuntimeError):
@@ -54,6 +46,35 @@ def run(cmd: list[str]) -> None:
         raise UserError(f"Command failed: {' '.join(cmd)}\n{proc.stdout}")
 
 
+def _cache_dir() -> Path:
+    # Shared with xray_reality_qr (x25519 cache); imported lazily to keep `--help` cheap.
+    import xray_reality_qr as xrq
+
+    return xrq.cache_dir()
+
+
+# ssh binds the master to "<ControlPath>.<16 random chars>" first; sun_path is 104 bytes on macOS
+# (108 on Linux) including the NUL, so longer paths make scp fail outright.
+_SOCKET_PATH_MAX = 103
+_SOCKET_TMP_SUFFIX_LEN = 17
+
+
+def _ssh_control_path(server: str, key_path: Path) -> Optional[str]:
+    # The mux socket lives in a private (0700) dir, as ssh_config(5) requires for ControlPath. Its short
+    # name hashes the key content with the target, so a different --ssh-private-key never reuses a session.
+    # Returns None when even that path would be too long for a unix socket; scp then runs unmultiplexed.
+    import hashlib
+
+    control_dir = _cache_dir() / "ssh"
+    name = hashlib.sha256(key_path.read_bytes() + f"\0root@{server}".encode()).hexdigest()[:20]
+    path = f"{control_dir}/{name}"
+    if len(os.fsencode(path)) + _SOCKET_TMP_SUFFIX_LEN > _SOCKET_PATH_MAX:
+        return None
+    control_dir.mkdir(parents=True, exist_ok=True)
+    os.chmod(control_dir, 0o700)
+    return path
+
+
 def scp_download(server: str, key_path: Path, remote_path: str, local_path: Path) -> None:
     cmd = [
         "scp",
@@ -65,19 +86,73 @@ def scp_download(server: str, key_path: Path, remote_path: str, local_path: Path
         "UserKnownHostsFile=/dev/null",
         "-o",
         "ConnectTimeout=10",
-        f"root@{server}:{remote_path}",
-        str(local_path),
     ]
+    # ControlMaster/ControlPersist let consecutive scp calls (also across CLI runs) reuse one SSH session.
+    control_path = _ssh_control_path(server, key_path)
+    if control_path is not None:
+        cmd += ["-o", "ControlMaster=auto", "-o", f"ControlPath={control_path}", "-o", "ControlPersist=60s"]
+    cmd += [f"root@{server}:{remote_path}", str(local_path)]
     run(cmd)
 
 
+_HTTP_ATTEMPTS = 3
+# Longer 429 back-offs are not waited out; the error is raised instead.
+_HTTP_MAX_RETRY_DELAY = 30
+
+
+def _retry_after(e: Any) -> Optional[float]:
+    # Telegram reports flood-wait as parameters.retry_after in the JSON body; fall back to the header.
+    try:
+        data = json.loads(e.read().decode("utf-8", errors="replace"))
+        return float(data["parameters"]["retry_after"])
+    except Exception:
+        pass
+    try:
+        return float(e.headers.get("Retry-After", ""))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _urlopen_with_retry(make_request: Callable[[], Any], timeout: float) -> Any:
+    # The Telegram calls are non-idempotent POSTs, so only failures where the request was certainly not
+    # processed are retried: HTTP 429, and URLError, which urllib raises only while connecting/sending.
+    # 5xx and errors while awaiting the response (e.g. read timeouts) propagate, since the message may
+    # already be posted. The request is rebuilt per attempt because streamed bodies can only be consumed once.
+    import time
+    from urllib.error import HTTPError, URLError
+    from urllib.request import urlopen
+
+    for attempt in range(_HTTP_ATTEMPTS):
+        try:
+            return urlopen(make_request(), timeout=timeout)
+        except HTTPError as e:
+            if attempt == _HTTP_ATTEMPTS - 1 or e.code != 429:
+                raise
+            delay = _retry_after(e)
+            e.close()
+            if delay is None:
+                delay = 2**attempt
+            if delay > _HTTP_MAX_RETRY_DELAY:
+                raise UserError(f"Telegram rate limit: retry after {delay:g}s")
+        except URLError:
+            if attempt == _HTTP_ATTEMPTS - 1:
+                raise
+            delay = 2**attempt
+        time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
 def tg_send_message(bot_token: str, chat_id: str, text: str) -> None:
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+    from urllib.request import Request
+
     url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
     data = urlencode({"chat_id": chat_id, "text": text}).encode("utf-8")
     req = Request(url, data=data, method="POST")
     req.add_header("Content-Type", "application/x-www-form-urlencoded")
     try:
-        with urlopen(req, timeout=20) as resp:
+        with _urlopen_with_retry(lambda: req, timeout=20) as resp:
             if resp.status >= 300:
                 body = resp.read().decode("utf-8", errors="replace")
                 raise UserError(f"Telegram sendMessage failed: HTTP {resp.status}\nResponse: {body}")
@@ -101,142 +176,253 @@ def tg_send_message(bot_token: str, chat_id: str, text: str) -> None:
         raise UserError(f"Telegram sendMessage failed: HTTP {e.code}\nResponse: {body}")
 
 
-def _multipart_form(fields: dict[str, str], files: dict[str, Path]) -> tuple[bytes, str]:
-    boundary = "----vpnxrayformboundary"
-    lines: list[bytes] = []
+def _multipart_form(fields: dict[str, str], files: dict[str, Path]) -> tuple[Iterator[bytes], int, str]:
+    # Returns a lazily-read body plus its exact length, so file parts are streamed
+    # to the socket in 64 KiB chunks instead of being held in memory.
+    import mimetypes
 
-    def add(b: bytes) -> None:
-        lines.append(b)
+    boundary = "----vpnxrayformboundary"
+    delim = b"--" + boundary.encode() + b"\r\n"
+    parts: list[Union[bytes, Path]] = []
+    # Consecutive header/field bytes are accumulated in one bytearray; only file parts break it up.
+    buf = bytearray()
 
     for name, value in fields.items():
-        add(f"--{boundary}\r\n".encode())
-        add(f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode())
-        add(value.encode("utf-8"))
-        add(b"\r\n")
+        buf += delim
+        buf += b'Content-Disposition: form-data; name="'
+        buf += name.encode()
+        buf += b'"\r\n\r\n'
+        buf += value.encode("utf-8")
+        buf += b"\r\n"
 
     for name, path in files.items():
         filename = path.name
         ctype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
-        add(f"--{boundary}\r\n".encode())
-        add(f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'.encode())
-        add(f"Content-Type: {ctype}\r\n\r\n".encode())
-        add(path.read_bytes())
-        add(b"\r\n")
-
-    add(f"--{boundary}--\r\n".encode())
-    body = b"".join(lines)
-    return body, boundary
+        buf += delim
+        buf += b'Content-Disposition: form-data; name="'
+        buf += name.encode()
+        buf += b'"; filename="'
+        buf += filename.encode()
+        buf += b'"\r\nContent-Type: '
+        buf += ctype.encode()
+        buf += b"\r\n\r\n"
+        parts.append(bytes(buf))
+        parts.append(path)
+        buf = bytearray(b"\r\n")
+
+    buf += b"--" + boundary.encode() + b"--\r\n"
+    parts.append(bytes(buf))
+    length = sum(p.stat().st_size if isinstance(p, Path) else len(p) for p in parts)
+    return _multipart_iter(parts), length, boundary
+
+
+def _multipart_iter(parts: list[Union[bytes, Path]]) -> Iterator[bytes]:
+    for part in parts:
+        if isinstance(part, Path):
+            with part.open("rb") as fh:
+                yield from iter(lambda: fh.read(65536), b"")
+        else:
+            yield part
 
 
 def tg_send_photo(bot_token: str, chat_id: str, photo_path: Path, caption: str = "") -> None:
+    from urllib.request import Request
+
     url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
-    body, boundary = _multipart_form(
-        fields={"chat_id": chat_id, "caption": caption},
-        files={"photo": photo_path},
-    )
-    req = Request(url, data=body, method="POST")
-    req.add_header("Content-Type", f"multipart/form-data; boundary={boundary}")
-    with urlopen(req, timeout=30) as resp:
+
+    def make_request() -> Request:
+        body, length, boundary = _multipart_form(
+            fields={"chat_id": chat_id, "caption": caption},
+            files={"photo": photo_path},
+        )
+        # urllib sends an iterable body chunk by chunk when Content-Length is given explicitly.
+        req = Request(url, data=body, method="POST")
+        req.add_header("Content-Type", f"multipart/form-data; boundary={boundary}")
+        req.add_header("Content-Length", str(length))
+        return req
+
+    with _urlopen_with_retry(make_request, timeout=30) as resp:
         if resp.status >= 300:
             raise UserError(f"Telegram sendPhoto failed: HTTP {resp.status}")
 
 
+def _load_xray_release_cache() -> dict[str, str]:
+    try:
+        data = json.loads((_cache_dir() / "xray-latest.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {k: v for k, v in data.items() if isinstance(v, str)}
+
+
+def _save_xray_release_cache(etag: str, tag: str, bin_path: Path) -> None:
+    cache_file = _cache_dir() / "xray-latest.json"
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(json.dumps({"etag": etag, "tag": tag, "bin_path": str(bin_path)}), encoding="utf-8")
+    except OSError:
+        pass
+
+
 def _download_latest_xray_linux_64(dest_dir: Path) -> Path:
+    import shutil
+    import tempfile
+    import zipfile
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    # Conditional request: GitHub answers 304 (empty body, no rate-limit cost) if the release is unchanged.
+    cache = _load_xray_release_cache()
+    cached_bin = cache.get("bin_path", "")
+    headers = {"Accept": "application/vnd.github+json"}
+    if cache.get("etag") and cached_bin and Path(cached_bin).exists():
+        headers["If-None-Match"] = cache["etag"]
+
     api = "https://api.github.com/repos/XTLS/Xray-core/releases/latest"
-    with urlopen(Request(api, headers={"Accept": "application/vnd.github+json"}), timeout=20) as resp:
-        if resp.status >= 300:
-            raise UserError(f"Failed to query Xray latest release: HTTP {resp.status}")
-        data = json.loads(resp.read().decode("utf-8"))
+    try:
+        with urlopen(Request(api, headers=headers), timeout=20) as resp:
+            if resp.status >= 300:
+                raise UserError(f"Failed to query Xray latest release: HTTP {resp.status}")
+            etag = resp.headers.get("ETag") or ""
+            data = json.loads(resp.read().decode("utf-8"))
+    except HTTPError as e:
+        if e.code == 304 and "If-None-Match" in headers:
+            return Path(cached_bin)
+        raise UserError(f"Failed to query Xray latest release: HTTP {e.code}")
     tag = data.get("tag_name")
     if not isinstance(tag, str) or not tag.strip():
         raise UserError("Failed to parse tag_name from GitHub releases API")
     tag = tag.strip()
 
+    # The ETag also changes with asset download counts, so a 200 often still means the same release.
+    if tag == cache.get("tag") and cached_bin and Path(cached_bin).exists():
+        if etag:
+            _save_xray_release_cache(etag, tag, Path(cached_bin))
+        return Path(cached_bin)
+
     url = f"https://github.com/XTLS/Xray-core/releases/download/{tag}/Xray-linux-64.zip"
     zip_path = dest_dir / "xray.zip"
-    with urlopen(Request(url), timeout=60) as resp:
-        if resp.status >= 300:
-            raise UserError(f"Failed to download xray zip: HTTP {resp.status}")
-        zip_path.write_bytes(resp.read())
-
-    with zipfile.ZipFile(zip_path) as z:
-        z.extract("xray", path=dest_dir)
     xray_path = dest_dir / "xray"
-    os.chmod(xray_path, 0o755)
+    try:
+        with urlopen(Request(url), timeout=60) as resp:
+            if resp.status >= 300:
+                raise UserError(f"Failed to download xray zip: HTTP {resp.status}")
+            with zip_path.open("wb") as f:
+                shutil.copyfileobj(resp, f, 1 << 16)
+
+        # dest_dir is a persistent cache: extract next to it and swap in atomically, so an interrupted
+        # extraction never leaves a truncated binary and a concurrently running xray is not rewritten.
+        fd, tmp = tempfile.mkstemp(dir=dest_dir, prefix=".xray-")
+        try:
+            with zipfile.ZipFile(zip_path) as z, z.open("xray") as src, os.fdopen(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 16)
+            os.chmod(tmp, 0o755)
+            os.replace(tmp, xray_path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+    finally:
+        zip_path.unlink(missing_ok=True)
+    if etag:
+        _save_xray_release_cache(etag, tag, xray_path)
     return xray_path
 
 
 def _ensure_xray_available() -> None:
-    # Respect XRAY_BIN if set; otherwise require xray in PATH or download temporary xray.
+    # Respect XRAY_BIN if set; otherwise require xray in PATH or download xray into the user cache dir.
     if os.environ.get("XRAY_BIN", "").strip():
         return
-    if shutil_which("xray"):
+    import shutil
+
+    if shutil.which("xray"):
         return
-    tmp = Path(tempfile.mkdtemp(prefix="xray-bin-"))
-    xray_path = _download_latest_xray_linux_64(tmp)
+    dest_dir = _cache_dir()
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    xray_path = _download_latest_xray_linux_64(dest_dir)
     os.environ["XRAY_BIN"] = str(xray_path)
 
 
-def shutil_which(cmd: str) -> Optional[str]:
-    path = os.environ.get("PATH", "")
-    for p in path.split(os.pathsep):
-        c = Path(p) / cmd
-        if c.exists() and os.access(c, os.X_OK):
-            return str(c)
-    return None
+def _compute_public_key(private_key: str) -> str:
+    import xray_reality_qr as xrq
+
+    # The xray binary is only fetched when it is actually needed, i.e. cryptography is missing
+    # and the public key is not in the on-disk cache yet.
+    try:
+        return xrq.compute_public_key_from_private(private_key)
+    except xrq.XrayNotFoundError:
+        _ensure_xray_available()
+        return xrq.compute_public_key_from_private(private_key)
 
 
 def cmd_qr(args: argparse.Namespace) -> int:
-    _ensure_xray_available()
-    cfg_any = xray_reality_qr._load_json(args.config)  # type: ignore[attr-defined]
-    cfg = xray_reality_qr._expect_dict(cfg_any, "root")  # type: ignore[attr-defined]
-    inbound = xray_reality_qr._select_inbound(cfg, args.inbound_index)  # type: ignore[attr-defined]
-    public_key = xray_reality_qr.compute_public_key_from_private(inbound.private_key)
-    link = xray_reality_qr.build_vless_link(args.server, args.name, args.fp, inbound, public_key)
+    import xray_reality_qr as xrq
+
+    cfg_any = xrq._load_json(args.config)  # type: ignore[attr-defined]
+    cfg = xrq._expect_dict(cfg_any, "root")  # type: ignore[attr-defined]
+    inbound = xrq._select_inbound(cfg, args.inbound_index)  # type: ignore[attr-defined]
+    public_key = _compute_public_key(inbound.private_key)
+    link = xrq.build_vless_link(args.server, args.name, args.fp, inbound, public_key)
 
     if args.dry_run:
         print(link)
         return 0
 
-    xray_reality_qr.qr_png(link, args.out)
+    # Only print-style output requested and no explicit --out: nobody consumes the PNG, so skip it.
+    if args.out is not None or not (args.print_link or args.print_qr):
+        xrq.qr_png(link, args.out or Path("vless.png"))
     if args.print_link:
         print(link)
     if args.print_qr:
-        xray_reality_qr.qr_ansi(link)
+        xrq.qr_ansi(link)
     return 0
 
 
 def cmd_generate(args: argparse.Namespace) -> int:
-    _ensure_xray_available()
+    import tempfile
+
+    import xray_reality_qr as xrq
 
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
     qr_path = out_dir / args.out_png
 
-    with tempfile.NamedTemporaryFile("w", delete=False) as f:
+    # mkstemp creates the file with O_EXCL and mode 0600, so the key is never readable by others.
+    fd, key_name = tempfile.mkstemp(prefix="vpn-key-", suffix=".pem")
+    key_path = Path(key_name)
+    with os.fdopen(fd, "w") as f:
         f.write(args.ssh_private_key)
         f.write("\n")
-        key_path = Path(f.name)
-    os.chmod(key_path, 0o600)
 
     try:
         local_cfg = out_dir / "server-config.json"
         scp_download(args.server, key_path, args.remote_config_path, local_cfg)
 
-        cfg_any = xray_reality_qr._load_json(local_cfg)  # type: ignore[attr-defined]
-        cfg = xray_reality_qr._expect_dict(cfg_any, "root")  # type: ignore[attr-defined]
-        inbound = xray_reality_qr._select_inbound(cfg, args.inbound_index)  # type: ignore[attr-defined]
-        public_key = xray_reality_qr.compute_public_key_from_private(inbound.private_key)
-        link = xray_reality_qr.build_vless_link(args.server, args.name, args.fp, inbound, public_key)
+        cfg_any = xrq._load_json(local_cfg)  # type: ignore[attr-defined]
+        cfg = xrq._expect_dict(cfg_any, "root")  # type: ignore[attr-defined]
+        inbound = xrq._select_inbound(cfg, args.inbound_index)  # type: ignore[attr-defined]
+        public_key = _compute_public_key(inbound.private_key)
+        link = xrq.build_vless_link(args.server, args.name, args.fp, inbound, public_key)
 
-        xray_reality_qr.qr_png(link, qr_path)
+        send_telegram = bool(args.telegram_bot_token and args.telegram_chat_id)
+        need_png = args.qr if args.qr is not None else send_telegram
+        if need_png:
+            xrq.qr_png(link, qr_path)
 
         if args.print_link:
             print(link)
 
-        if args.telegram_bot_token and args.telegram_chat_id:
-            tg_send_message(args.telegram_bot_token, args.telegram_chat_id, f"VLESS Reality link:\n{link}")
-            tg_send_photo(args.telegram_bot_token, args.telegram_chat_id, qr_path, caption="VLESS Reality QR")
+        if send_telegram:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # Both requests are independent, so overlap their round-trips. The photo may therefore
+            # show up in the chat before the link text.
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                futures = [ex.submit(tg_send_message, args.telegram_bot_token, args.telegram_chat_id, f"VLESS Reality link:\n{link}")]
+                if need_png:
+                    futures.append(ex.submit(tg_send_photo, args.telegram_bot_token, args.telegram_chat_id, qr_path, "VLESS Reality QR"))
+                for f in futures:
+                    f.result()
 
         return 0
     finally:
@@ -246,22 +432,26 @@ def cmd_generate(args: argparse.Namespace) -> int:
             pass
 
 
-def build_parser() -> argparse.ArgumentParser:
-    p = argparse.ArgumentParser(prog="vpn_cli", description="VPN/Xray helper CLI for this repo")
-    sub = p.add_subparsers(dest="cmd", required=True)
-
+def _add_qr(sub: argparse._SubParsersAction) -> None:
     qr = sub.add_parser("qr", help="Generate vless link + QR from local server config JSON")
     qr.add_argument("config", type=Path, help="Path to Xray server config.json")
     qr.add_argument("--server", required=True, help="Public server host/IP used in the link")
     qr.add_argument("--name", default="reality-443", help="URL fragment (#name). Default: reality-443")
     qr.add_argument("--fp", default="chrome", help="Fingerprint (fp=). Default: chrome")
-    qr.add_argument("--out", type=Path, default=Path("vless.png"), help="PNG output filename. Default: vless.png")
+    qr.add_argument(
+        "--out",
+        type=Path,
+        default=None,
+        help="PNG output filename. Default: vless.png (not written with --print-link/--print-qr unless --out is given)",
+    )
     qr.add_argument("--print-link", action="store_true")
     qr.add_argument("--print-qr", action="store_true")
     qr.add_argument("--dry-run", action="store_true")
     qr.add_argument("--inbound-index", type=int, default=None)
     qr.set_defaults(func=cmd_qr)
 
+
+def _add_generate(sub: argparse._SubParsersAction) -> None:
     gen = sub.add_parser("generate", help="Download server config via SSH and send link+QR to Telegram")
     gen.add_argument("--server", required=True, help="Public server host/IP used in the link")
     gen.add_argument("--ssh-private-key", required=True, help="SSH private key content (OpenSSH format)")
@@ -274,13 +464,47 @@ def build_parser() -> argparse.ArgumentParser:
     gen.add_argument("--inbound-index", type=int, default=None)
     gen.add_argument("--telegram-bot-token", default="", help="Telegram bot token (optional)")
     gen.add_argument("--telegram-chat-id", default="", help="Telegram chat id or @channel (optional)")
+    gen.add_argument(
+        "--qr",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Write the QR PNG. Default: only when sending to Telegram",
+    )
     gen.set_defaults(func=cmd_generate)
 
+
+_SUBCOMMANDS = {"qr": _add_qr, "generate": _add_generate}
+
+
+def _sniff_subcommand(argv: list[str]) -> Optional[str]:
+    # The top-level parser has no options besides -h, so the first non-flag token is the subcommand.
+    # A -h/--help before it asks for top-level help, which must list every subcommand.
+    for tok in argv:
+        if tok in ("-h", "--help"):
+            return None
+        if tok.startswith("-"):
+            continue
+        return tok if tok in _SUBCOMMANDS else None
+    return None
+
+
+def build_parser(cmd: Optional[str] = None) -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(prog="vpn_cli", description="VPN/Xray helper CLI for this repo")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    if cmd is not None:
+        _SUBCOMMANDS[cmd](sub)
+    else:
+        for add in _SUBCOMMANDS.values():
+            add(sub)
+
     return p
 
 
 def main(argv: Optional[list[str]] = None) -> int:
-    args = build_parser().parse_args(argv)
+    if argv is None:
+        argv = sys.argv[1:]
+    args = build_parser(_sniff_subcommand(argv)).parse_args(argv)
     return int(args.func(args))
 
 
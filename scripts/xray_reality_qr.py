@@ -20,22 +20,26 @@ vless://{uuid}@{server}:{port}?type={network}&security=reality&sni={sni}&fp={fp}
 from __future__ import annotations
 
 import argparse
+import functools
 import json
 import os
-import re
-import subprocess
 import sys
-import uuid as uuid_lib
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, NoReturn, Optional
-from urllib.parse import quote, urlencode
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple, NoReturn, Optional
+
+if TYPE_CHECKING:
+    import re
 
 
 class UserError(RuntimeError):
     pass
 
 
+class XrayNotFoundError(UserError):
+    pass
+
+
 @dataclass(frozen=True)
 class RealityInbound:
     uuid: str
@@ -47,8 +51,22 @@ class RealityInbound:
     private_key: str
 
 
-_B64URL_RE = re.compile(r"^[A-Za-z0-9_-]{32,}$")
-_HEX_RE = re.compile(r"^[0-9a-fA-F]+$")
+class _Patterns(NamedTuple):
+    b64url_match: Callable[[str], Optional[re.Match[str]]]
+    hex_match: Callable[[str], Optional[re.Match[str]]]
+    uuid_match: Callable[[str], Optional[re.Match[str]]]
+
+
+# Regexes are compiled on first use so that importing this module (e.g. for `vpn_cli --help`) stays cheap.
+@functools.cache
+def _patterns() -> _Patterns:
+    import re
+
+    return _Patterns(
+        b64url_match=re.compile(r"^[A-Za-z0-9_-]{32,}$").match,
+        hex_match=re.compile(r"^[0-9a-fA-F]+$").match,
+        uuid_match=re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}").fullmatch,
+    )
 
 
 def _die(msg: str, code: int = 2) -> NoReturn:
@@ -56,9 +74,20 @@ def _die(msg: str, code: int = 2) -> NoReturn:
     raise SystemExit(code)
 
 
+@functools.cache
+def _json_loads() -> Callable[[bytes], Any]:
+    # orjson is an optional speedup; both parsers take bytes and raise json.JSONDecodeError subclasses.
+    try:
+        import orjson  # type: ignore
+
+        return orjson.loads
+    except ImportError:
+        return json.loads
+
+
 def _load_json(path: Path) -> Any:
     try:
-        return json.loads(path.read_text(encoding="utf-8"))
+        return _json_loads()(path.read_bytes())
     except FileNotFoundError:
         raise UserError(f"Config file not found: {path}")
     except json.JSONDecodeError as e:
@@ -90,21 +119,19 @@ def _expect_int(v: Any, where: str) -> int:
 
 
 def _validate_uuid(u: str) -> None:
-    try:
-        uuid_lib.UUID(u)
-    except Exception:
+    if not _patterns().uuid_match(u):
         raise UserError(f"Invalid UUID: {u}")
 
 
 def _validate_short_id(sid: str) -> None:
-    if not _HEX_RE.match(sid):
+    if not _patterns().hex_match(sid):
         raise UserError(f"shortId must be hex, got: {sid}")
     if len(sid) % 2 != 0:
         raise UserError(f"shortId must have even length, got len={len(sid)} ({sid})")
 
 
 def _validate_private_key(pk: str) -> None:
-    if not _B64URL_RE.match(pk):
+    if not _patterns().b64url_match(pk):
         raise UserError(f"privateKey has unexpected format: {pk}")
 
 
@@ -113,6 +140,15 @@ def _select_inbound(cfg: dict[str, Any], inbound_index: Optional[int]) -> Realit
     if not inbounds:
         raise UserError("No inbounds found in config")
 
+    def matches(inbound_any: Any) -> bool:
+        if not isinstance(inbound_any, dict) or inbound_any.get("protocol") != "vless":
+            return False
+        stream = inbound_any.get("streamSettings")
+        if not isinstance(stream, dict):
+            return False
+        security = stream.get("security")
+        return isinstance(security, str) and security.strip() == "reality"
+
     def parse_one(idx: int, inbound_any: Any) -> RealityInbound:
         ib = _expect_dict(inbound_any, f"inbounds[{idx}]")
         protocol = ib.get("protocol")
@@ -171,18 +207,113 @@ def _select_inbound(cfg: dict[str, Any], inbound_index: Optional[int]) -> Realit
             raise UserError(f"--inbound-index {inbound_index} is out of range (0..{len(inbounds)-1})")
         return parse_one(inbound_index, inbounds[inbound_index])
 
-    last_err: Optional[Exception] = None
+    # Auto-detect: cheaply skip inbounds that are not vless+reality; the first candidate is then
+    # validated strictly, so a malformed Reality inbound is reported rather than silently skipped.
     for idx, ib in enumerate(inbounds):
-        try:
+        if matches(ib):
             return parse_one(idx, ib)
-        except Exception as e:
-            last_err = e
-            continue
-    raise UserError(f"No matching inbound found (need protocol=vless + security=reality). Last error: {last_err}")
+    raise UserError("No matching inbound found (need protocol=vless + security=reality)")
+
+
+def cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "vpn-xray"
+
+
+def _x25519_cache_path(private_key: str) -> Path:
+    import hashlib
+
+    h = hashlib.sha256(private_key.encode()).hexdigest()[:16]
+    return cache_dir() / "x25519" / h
+
 
+def _xray_stamp(xray: str) -> Optional[str]:
+    # mtime of the resolved xray binary, or None if there is no binary to compare against.
+    import shutil
+
+    resolved = shutil.which(xray)
+    try:
+        return str(os.stat(resolved).st_mtime_ns) if resolved else None
+    except OSError:
+        return None
+
+
+def _read_cached_public_key(path: Path, stamp: Optional[str]) -> Optional[str]:
+    # An entry written by a different xray binary is ignored, but only when a binary is available to
+    # recompute with; without one the cached key is still used so no download is needed.
+    try:
+        entry = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict):
+        return None
+    pub = entry.get("pub")
+    if not isinstance(pub, str) or not _patterns().b64url_match(pub):
+        return None
+    if stamp is not None and entry.get("xray_stamp") != stamp:
+        return None
+    return pub
 
+
+def _write_cached_public_key(path: Path, pub: str, stamp: Optional[str]) -> None:
+    import tempfile
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"pub": pub, "xray_stamp": stamp}, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+@functools.cache
+def native_x25519_available() -> bool:
+    try:
+        import cryptography.hazmat.primitives.asymmetric.x25519  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _x25519_public_key_native(private_key: str) -> str:
+    import base64
+
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+    try:
+        raw = base64.urlsafe_b64decode(private_key + "=" * (-len(private_key) % 4))
+    except ValueError:
+        raise UserError(f"privateKey is not valid base64url: {private_key}")
+    if len(raw) != 32:
+        raise UserError(f"privateKey must decode to 32 bytes, got {len(raw)}")
+    pub_raw = X25519PrivateKey.from_private_bytes(raw).public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    )
+    return base64.urlsafe_b64encode(pub_raw).rstrip(b"=").decode("ascii")
+
+
+@functools.lru_cache(maxsize=64)
 def compute_public_key_from_private(private_key: str) -> str:
+    # Prefer the in-process computation; the xray subprocess is only a fallback when `cryptography` is missing.
+    if native_x25519_available():
+        return _x25519_public_key_native(private_key)
+
     xray = os.environ.get("XRAY_BIN", "xray")
+    cache_path = _x25519_cache_path(private_key)
+    stamp = _xray_stamp(xray)
+    pub = _read_cached_public_key(cache_path, stamp)
+    if pub is None:
+        pub = _x25519_public_key_via_xray(xray, private_key)
+        _write_cached_public_key(cache_path, pub, _xray_stamp(xray))
+    return pub
+
+
+def _x25519_public_key_via_xray(xray: str, private_key: str) -> str:
+    import re
+    import subprocess
+
     try:
         proc = subprocess.run(
             [xray, "x25519", "-i", private_key],
@@ -192,7 +323,7 @@ def compute_public_key_from_private(private_key: str) -> str:
             text=True,
         )
     except FileNotFoundError:
-        raise UserError(
+        raise XrayNotFoundError(
             "xray binary not found in PATH. Install xray or set XRAY_BIN to the xray executable path.\n"
             "Example: export XRAY_BIN=/usr/local/bin/xray"
         )
@@ -209,12 +340,14 @@ def compute_public_key_from_private(private_key: str) -> str:
     if not m:
         raise UserError(f"Failed to parse public key from xray output:\n{out}")
     pub = m.group(1).strip()
-    if not _B64URL_RE.match(pub):
+    if not _patterns().b64url_match(pub):
         raise UserError(f"Parsed publicKey has unexpected format: {pub}")
     return pub
 
 
 def build_vless_link(server: str, name: str, fp: str, inbound: RealityInbound, public_key: str) -> str:
+    from urllib.parse import quote, urlencode
+
     params: dict[str, str] = {
         "type": inbound.network,
         "security": "reality",
@@ -231,24 +364,57 @@ def build_vless_link(server: str, name: str, fp: str, inbound: RealityInbound, p
     return f"vless://{inbound.uuid}@{server}:{inbound.port}?{query}#{frag}"
 
 
+# Pixels per QR module in the PNG output (same as qrcode's default box_size).
+_QR_BOX_SIZE = 10
+
+
+def _png_1bit(matrix: list[list[bool]], scale: int) -> bytes:
+    # Minimal grayscale 1-bit PNG writer: a set module is a black (0) pixel, everything else is white (1).
+    import struct
+    import zlib
+
+    width = len(matrix[0]) * scale
+    height = len(matrix) * scale
+    raw = bytearray()
+    for row in matrix:
+        line = bytearray(1)  # filter type 0 (None)
+        acc, nbits = 0, 0
+        for cell in row:
+            for _ in range(scale):
+                acc = (acc << 1) | (0 if cell else 1)
+                nbits += 1
+                if nbits == 8:
+                    line.append(acc)
+                    acc, nbits = 0, 0
+        if nbits:
+            line.append(acc << (8 - nbits))
+        raw += bytes(line) * scale
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(bytes(raw), 9)) + chunk(b"IEND", b"")
+
+
 def qr_png(link: str, out_path: Path) -> None:
     try:
         import qrcode  # type: ignore
     except Exception:
-        raise UserError("Python dependency 'qrcode' is missing. Install: python3 -m pip install 'qrcode[pil]'")
+        raise UserError("Python dependency 'qrcode' is missing. Install: python3 -m pip install qrcode")
 
     qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=2)
     qr.add_data(link)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    img.save(out_path)
+    # get_matrix() already includes the quiet-zone border; rasterize it ourselves to avoid importing Pillow.
+    out_path.write_bytes(_png_1bit(qr.get_matrix(), _QR_BOX_SIZE))
 
 
 def qr_ansi(link: str) -> None:
     try:
         import qrcode  # type: ignore
     except Exception:
-        raise UserError("Python dependency 'qrcode' is missing (needed for --print-qr). Install: python3 -m pip install 'qrcode[pil]'")
+        raise UserError("Python dependency 'qrcode' is missing (needed for --print-qr). Install: python3 -m pip install qrcode")
 
     qr = qrcode.QRCode(border=1)
     qr.add_data(link)